@@ -1,12 +1,16 @@
 import os
+import re
 import sys
 import psutil
 import asyncio
-import json
+import gzip
+import hashlib
+import time
+import orjson
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-import requests
-from xml.etree import ElementTree
+from typing import List, Dict, Any, Optional, BinaryIO, Sequence, Tuple
+import aiohttp
+from lxml import etree
 from urllib.parse import urljoin
 from pathlib import Path
 
@@ -14,6 +18,7 @@ from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
 from crawl4ai.extraction_strategy import JsonCssExtractionStrategy
 from crawl4ai.content_filter_strategy import PruningContentFilter
 from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 # Define the extraction schema for baretread.com
 blog_schema = {
@@ -57,9 +62,108 @@ blog_schema = {
     ]
 }
 
-def get_sitemap_urls(base_url: str) -> List[str]:
-    """Fetch URLs from sitemap(s)"""
+# Sitemap XML namespace and the Clark-notation <loc> tag the parser filters on
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+SITEMAP_LOC_TAG = f'{{{SITEMAP_NS}}}loc'
+
+# Sitemap fetching: cap parallel connections per host and retry transient failures
+SITEMAP_MAX_PER_HOST = 16
+SITEMAP_MAX_RETRIES = 3
+SITEMAP_BACKOFF_BASE = 0.5  # seconds, doubled on each retry
+SITEMAP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+SITEMAP_CHUNK_SIZE = 32 * 1024
+# Fail fast on unreachable hosts and stalled reads; no overall cap, since a
+# large sitemap can legitimately take a while to stream
+SITEMAP_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=5, sock_read=15)
+SITEMAP_CACHE_DIR = Path("output") / ".sitemap_cache"
+SITEMAP_CACHE_TTL = 24 * 60 * 60  # seconds
+# Statuses meaning a sitemap location doesn't exist, as opposed to a failed fetch
+SITEMAP_MISSING_STATUSES = {404, 410}
+SITEMAP_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; BareTreadCrawler/1.0)"}
+
+def drain_sitemap_locs(parser: etree.XMLPullParser, locs: List[str]):
+    """Collect parsed <loc> values, dropping each entry once it's been read"""
+    append = locs.append
+    for _, loc in parser.read_events():
+        text = loc.text
+        if text:
+            append(text)
+        loc.clear()
+        # Drop the already-consumed <url>/<sitemap> entries so the tree never grows
+        entry = loc.getparent()
+        if entry is not None:
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+
+async def stream_sitemap_locs(response: aiohttp.ClientResponse) -> List[str]:
+    """Feed a sitemap response into the XML parser chunk by chunk as it downloads"""
+    parser = etree.XMLPullParser(
+        events=('end',),
+        tag=SITEMAP_LOC_TAG,
+        resolve_entities=False
+    )
+    locs = []
+    async for chunk in response.content.iter_chunked(SITEMAP_CHUNK_SIZE):
+        parser.feed(chunk)
+        drain_sitemap_locs(parser, locs)
+    parser.close()
+    drain_sitemap_locs(parser, locs)
+    return locs
+
+async def fetch_sitemap_locs(session: aiohttp.ClientSession, url: str) -> List[str]:
+    """Fetch a sitemap's locations, retrying with exponential backoff on transient errors"""
+    for attempt in range(SITEMAP_MAX_RETRIES):
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await stream_sitemap_locs(response)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in SITEMAP_RETRY_STATUSES or attempt == SITEMAP_MAX_RETRIES - 1:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == SITEMAP_MAX_RETRIES - 1:
+                raise
+        await asyncio.sleep(SITEMAP_BACKOFF_BASE * 2 ** attempt)
+
+def sitemap_cache_path(base_url: str) -> Path:
+    """Location of the cached sitemap discovery result for a site"""
+    return SITEMAP_CACHE_DIR / f"{hashlib.sha1(base_url.encode()).hexdigest()}.json"
+
+def load_cached_sitemap_urls(base_url: str) -> Optional[Tuple[str, ...]]:
+    """Return URLs from a previous discovery run if the cache is still fresh"""
+    cache_file = sitemap_cache_path(base_url)
+    try:
+        if time.time() - cache_file.stat().st_mtime > SITEMAP_CACHE_TTL:
+            return None
+        return tuple(orjson.loads(cache_file.read_bytes()))
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def save_cached_sitemap_urls(base_url: str, urls: Tuple[str, ...]):
+    """Persist discovered URLs so reruns can skip sitemap discovery"""
+    cache_file = sitemap_cache_path(base_url)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_bytes(orjson.dumps(urls))
+    except OSError as e:
+        print(f"Error caching sitemap URLs for {base_url}: {e}")
+
+async def get_sitemap_urls(base_url: str, refresh: bool = False) -> Tuple[str, ...]:
+    """Fetch URLs from sitemap(s)
+    
+    A fresh cached result is reused unless refresh is set. Results are only
+    cached when every sitemap fetch succeeded, so a failed sub-sitemap can't
+    silently drop its pages from later runs.
+    """
+    if not refresh:
+        cached = load_cached_sitemap_urls(base_url)
+        if cached:
+            print(f"Using {len(cached)} cached sitemap URLs for {base_url}")
+            return cached
+    
     urls = set()
+    seen_sitemaps = set()
+    complete = True
     
     # Try common sitemap locations
     sitemap_locations = [
@@ -69,43 +173,68 @@ def get_sitemap_urls(base_url: str) -> List[str]:
         "/wp-sitemap.xml"  # WordPress sitemap
     ]
     
-    for sitemap_path in sitemap_locations:
-        sitemap_url = urljoin(base_url, sitemap_path)
-        try:
-            response = requests.get(sitemap_url)
-            response.raise_for_status()
-            
-            root = ElementTree.fromstring(response.content)
-            # Handle both sitemap and sitemap index
-            namespace = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-            
-            # First try to find sitemap locations (in case this is a sitemap index)
-            sitemaps = root.findall('.//ns:loc', namespace)
-            
-            # If this is a sitemap index, fetch each sitemap
-            if any(loc.text and loc.text.endswith('.xml') for loc in sitemaps):
-                for sitemap in sitemaps:
-                    if sitemap.text and sitemap.text.endswith('.xml'):
-                        try:
-                            sub_response = requests.get(sitemap.text)
-                            sub_response.raise_for_status()
-                            sub_root = ElementTree.fromstring(sub_response.content)
-                            urls.update(loc.text for loc in sub_root.findall('.//ns:loc', namespace))
-                        except Exception as e:
-                            print(f"Error fetching sub-sitemap {sitemap.text}: {e}")
-            else:
-                # This is a regular sitemap, just get the URLs
-                urls.update(loc.text for loc in sitemaps)
-            
-            if urls:
-                print(f"Found {len(urls)} URLs in {sitemap_url}")
-                break
+    # One keep-alive session for every sitemap request, so connections are reused
+    connector = aiohttp.TCPConnector(limit_per_host=SITEMAP_MAX_PER_HOST)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers=SITEMAP_HEADERS,
+        timeout=SITEMAP_TIMEOUT
+    ) as session:
+        for sitemap_path in sitemap_locations:
+            sitemap_url = urljoin(base_url, sitemap_path)
+            if sitemap_url in seen_sitemaps:
+                continue
+            seen_sitemaps.add(sitemap_url)
+            try:
+                locs = await fetch_sitemap_locs(session, sitemap_url)
                 
-        except Exception as e:
-            print(f"Error fetching sitemap {sitemap_url}: {e}")
-            continue
+                # Sort locations in one pass: .xml entries are sub-sitemaps of
+                # an index, everything else is a page URL
+                sub_urls = []
+                for loc in locs:
+                    if not loc.endswith('.xml'):
+                        urls.add(loc)
+                    elif loc not in seen_sitemaps:
+                        seen_sitemaps.add(loc)
+                        sub_urls.append(loc)
+                
+                # Fetch all sub-sitemaps concurrently
+                if sub_urls:
+                    sub_results = await asyncio.gather(
+                        *(fetch_sitemap_locs(session, sub_url) for sub_url in sub_urls),
+                        return_exceptions=True
+                    )
+                    for sub_url, sub_result in zip(sub_urls, sub_results):
+                        if isinstance(sub_result, asyncio.TimeoutError):
+                            print(f"Timed out fetching sub-sitemap {sub_url}")
+                            complete = False
+                            continue
+                        if isinstance(sub_result, Exception):
+                            print(f"Error fetching sub-sitemap {sub_url}: {sub_result}")
+                            complete = False
+                            continue
+                        urls.update(sub_result)
+                
+                if urls:
+                    print(f"Found {len(urls)} URLs in {sitemap_url}")
+                    break
+                    
+            except asyncio.TimeoutError:
+                print(f"Timed out fetching sitemap {sitemap_url}")
+                complete = False
+                continue
+            except Exception as e:
+                print(f"Error fetching sitemap {sitemap_url}: {e}")
+                if not (isinstance(e, aiohttp.ClientResponseError) and e.status in SITEMAP_MISSING_STATUSES):
+                    complete = False
+                continue
     
-    return list(urls)
+    result = tuple(urls)
+    if result and complete:
+        save_cached_sitemap_urls(base_url, result)
+    elif result:
+        print(f"Not caching sitemap URLs for {base_url}: some sitemaps failed to load")
+    return result
 
 def setup_output_directory() -> Path:
     """Create and return output directory with timestamp"""
@@ -114,18 +243,23 @@ def setup_output_directory() -> Path:
     output_dir.mkdir(parents=True, exist_ok=True)
     return output_dir
 
-async def save_batch_results(results: List[Dict], output_dir: Path):
-    """Save results in an organized structure with separate files for different types of data"""
-    results_file = output_dir / "results.jsonl"
-    stats_file = output_dir / "stats.json"
-    errors_file = output_dir / "errors.jsonl"
-    metadata_file = output_dir / "metadata.json"
+def write_jsonl_lines(f: BinaryIO, lines: List[bytes]):
+    """Write and flush encoded JSONL lines in a single call"""
+    f.write(b"".join(lines))
+    f.flush()
+
+async def save_batch_results(results: List[Dict], results_file: BinaryIO, errors_file: BinaryIO):
+    """Append a batch of results to the already-open results and errors JSONL files"""
+    result_lines = []
+    error_lines = []
+    # Every record in a batch is saved at the same moment
+    timestamp = datetime.now().isoformat()
     
     for result in results:
         # Enhanced content structure for LLM consumption
         content = {
             "url": result["url"],
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp,
             "content": {
                 "title": result.get("title", ""),
                 "raw_markdown": result.get("raw_markdown", ""),
@@ -143,20 +277,68 @@ async def save_batch_results(results: List[Dict], output_dir: Path):
             },
             "links": result.get("links", {})
         }
-        
-        with open(results_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(content, ensure_ascii=False) + "\n")
+        result_lines.append(orjson.dumps(content) + b"\n")
         
         if "error" in result:
-            with open(errors_file, "a", encoding="utf-8") as f:
-                error_entry = {
-                    "url": result["url"],
-                    "timestamp": datetime.now().isoformat(),
-                    "error": result["error"]
-                }
-                f.write(json.dumps(error_entry, ensure_ascii=False) + "\n")
+            error_entry = {
+                "url": result["url"],
+                "timestamp": timestamp,
+                "error": result["error"]
+            }
+            error_lines.append(orjson.dumps(error_entry) + b"\n")
+    
+    # One write per file for the whole batch, run off the event loop so disk
+    # I/O doesn't stall in-flight crawls
+    if result_lines:
+        await asyncio.to_thread(write_jsonl_lines, results_file, result_lines)
+    
+    if error_lines:
+        await asyncio.to_thread(write_jsonl_lines, errors_file, error_lines)
+
+# Page crawling: back off exponentially when a site rate-limits us or times out
+CRAWL_MAX_RETRIES = 3
+CRAWL_BACKOFF_BASE = 2.0  # seconds, doubled on each retry
+CRAWL_RETRY_STATUSES = {429, 503}
+TIMEOUT_ERRORS = (asyncio.TimeoutError, TimeoutError, PlaywrightTimeoutError)
+# arun catches page timeouts and reports them as a failed result, so they are
+# recognised from Playwright's "Timeout 30000ms exceeded" message (or
+# crawl4ai's "Timeout after 30000ms" for selector waits)
+TIMEOUT_MESSAGE = re.compile(r"Timeout (?:\d+ms exceeded|after \d+ms)")
+
+def is_timeout(result: Any) -> bool:
+    """Whether a crawl outcome, a failed result or an escaped exception, was a timeout"""
+    if isinstance(result, BaseException):
+        return isinstance(result, TIMEOUT_ERRORS)
+    return not result.success and bool(TIMEOUT_MESSAGE.search(result.error_message or ""))
 
-async def crawl_parallel(urls: List[str], output_dir: Path, max_concurrent: int = 3) -> Dict[str, int]:
+async def arun_with_backoff(crawler: AsyncWebCrawler, url: str, config: CrawlerRunConfig):
+    """Crawl a single URL, retrying rate-limited (429/503) and timed-out attempts"""
+    for attempt in range(CRAWL_MAX_RETRIES):
+        if attempt:
+            await asyncio.sleep(CRAWL_BACKOFF_BASE * 2 ** (attempt - 1))
+        last_attempt = attempt == CRAWL_MAX_RETRIES - 1
+        try:
+            result = await crawler.arun(url=url, config=config)
+        except TIMEOUT_ERRORS:
+            if last_attempt:
+                raise
+        else:
+            retryable = result.status_code in CRAWL_RETRY_STATUSES or is_timeout(result)
+            if not retryable or last_attempt:
+                return result
+
+async def result_writer(queue: asyncio.Queue, results_file: BinaryIO, errors_file: BinaryIO):
+    """Drain result batches from the queue to disk until a None sentinel arrives"""
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            break
+        try:
+            await save_batch_results(batch, results_file, errors_file)
+        except Exception as e:
+            print(f"Error saving batch of {len(batch)} results: {e}")
+
+async def crawl_parallel(urls: Sequence[str], output_dir: Path, max_concurrent: int = 3) -> Dict[str, int]:
     """Crawl URLs in parallel with enhanced content filtering and markdown generation"""
     print(f"\n=== Starting parallel crawl of {len(urls)} URLs ===")
     
@@ -207,6 +389,16 @@ async def crawl_parallel(urls: List[str], output_dir: Path, max_concurrent: int
     crawler = AsyncWebCrawler(config=browser_config)
     await crawler.start()
     
+    # Keep the output files open for the whole crawl. Results are markdown-heavy
+    # so they're gzipped at a fast level; flushing after each batch writes a
+    # sync point, so the file can be read while the crawl is still running
+    results_file = gzip.open(output_dir / "results.jsonl.gz", "ab", compresslevel=1)
+    errors_file = open(output_dir / "errors.jsonl", "ab")
+    
+    # Save finished batches in the background while the next batch crawls
+    save_queue = asyncio.Queue(maxsize=4)
+    writer_task = asyncio.create_task(result_writer(save_queue, results_file, errors_file))
+    
     stats = {
         "success": 0,
         "failed": 0,
@@ -214,71 +406,77 @@ async def crawl_parallel(urls: List[str], output_dir: Path, max_concurrent: int
         "error": 0
     }
     
+    crawl_slots = asyncio.Semaphore(max_concurrent)
+    
+    async def crawl_one(url: str):
+        async with crawl_slots:
+            try:
+                return url, await arun_with_backoff(crawler, url, crawl_config)
+            except Exception as e:
+                return url, e
+    
+    batch_results = []
+    
     try:
-        # Process URLs in smaller batches
-        for i in range(0, len(urls), max_concurrent):
-            batch = urls[i:i + max_concurrent]
-            tasks = []
-            batch_results = []
-            
-            for j, url in enumerate(batch):
-                session_id = f"session_{i + j}"
-                task = crawler.arun(
-                    url=url,
-                    config=crawl_config,
-                    session_id=session_id
-                )
-                tasks.append(task)
-            
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Dispatch every URL at once; the semaphore keeps max_concurrent in flight
+        # and a slot frees up as soon as any single page finishes
+        for next_done in asyncio.as_completed([crawl_one(url) for url in urls]):
+            url, result = await next_done
+            if isinstance(result, Exception):
+                print(f"Error crawling {url}: {result}")
+                if is_timeout(result):
+                    stats["timeout"] += 1
+                else:
+                    stats["error"] += 1
+                continue
             
-            for url, result in zip(batch, results):
-                if isinstance(result, Exception):
-                    print(f"Error crawling {url}: {result}")
-                    if "timeout" in str(result).lower():
-                        stats["timeout"] += 1
-                    else:
-                        stats["error"] += 1
-                    continue
-                
-                if result.success:
-                    try:
-                        # Extract content safely
-                        content = result.extracted_content
-                        if not isinstance(content, dict):
-                            content = {}
-                        
-                        # Get markdown result safely
-                        md_result = getattr(result, 'markdown_v2', None)
-                        
-                        result_dict = {
-                            "url": url,
-                            "raw_markdown": md_result.raw_markdown if md_result else "",
-                            "fit_markdown": md_result.fit_markdown if md_result else "",
-                            "title": content.get("title", ""),
-                            "date": content.get("date", ""),
-                            "categories": content.get("categories", []),
-                            "tags": content.get("tags", []),
-                            "word_count": len(md_result.raw_markdown.split()) if md_result and md_result.raw_markdown else 0
-                        }
-                        
-                        batch_results.append(result_dict)
-                        stats["success"] += 1
-                        print(f"Successfully crawled ({stats['success']}/{len(urls)}): {url}")
-                    except Exception as e:
-                        print(f"Error processing results for {url}: {e}")
-                        stats["error"] += 1
+            if result.success:
+                try:
+                    # Extract content safely
+                    content = result.extracted_content
+                    if not isinstance(content, dict):
+                        content = {}
+                    
+                    # Get markdown result safely
+                    md_result = getattr(result, 'markdown_v2', None)
+                    
+                    result_dict = {
+                        "url": url,
+                        "raw_markdown": md_result.raw_markdown if md_result else "",
+                        "fit_markdown": md_result.fit_markdown if md_result else "",
+                        "title": content.get("title", ""),
+                        "date": content.get("date", ""),
+                        "categories": content.get("categories", []),
+                        "tags": content.get("tags", []),
+                        "word_count": len(md_result.raw_markdown.split()) if md_result and md_result.raw_markdown else 0
+                    }
+                    
+                    batch_results.append(result_dict)
+                    stats["success"] += 1
+                    print(f"Successfully crawled ({stats['success']}/{len(urls)}): {url}")
+                except Exception as e:
+                    print(f"Error processing results for {url}: {e}")
+                    stats["error"] += 1
+            else:
+                print(f"Failed to crawl {url}: {result.error_message}")
+                if is_timeout(result):
+                    stats["timeout"] += 1
                 else:
-                    print(f"Failed to crawl {url}: {result.error_message}")
                     stats["failed"] += 1
             
-            if batch_results:
-                await save_batch_results(batch_results, output_dir)
-            
-            # Small delay between batches
-            await asyncio.sleep(1)
+            # Hand results to the writer in chunks rather than one by one
+            if len(batch_results) >= max_concurrent:
+                await save_queue.put(batch_results)
+                batch_results = []
+        
+        if batch_results:
+            await save_queue.put(batch_results)
     
     finally:
+        await save_queue.put(None)
+        await writer_task
+        results_file.close()
+        errors_file.close()
         await crawler.close()
     
     return stats
@@ -286,7 +484,8 @@ async def crawl_parallel(urls: List[str], output_dir: Path, max_concurrent: int
 async def main():
     # Get URLs from sitemap
     base_url = "https://baretread.com"
-    urls = get_sitemap_urls(base_url)
+    # SITEMAP_REFRESH=1 forces a fresh discovery instead of using the cache
+    urls = await get_sitemap_urls(base_url, refresh=os.getenv("SITEMAP_REFRESH") == "1")
     
     if not urls:
         print("No URLs found in sitemap. Exiting...")
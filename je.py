@@ -8,22 +8,29 @@ headers = {
     "Authorization": "Bearer jeremy"
 }
 
-# Test crawl - note the "urls" field instead of "url"
-response = requests.post(
-    f"{url}/crawl",
-    headers=headers,
-    json={
-        "urls": "https://example.com",  # Changed from url to urls
-        "priority": 10
-    }
-)
-print(response.json())
+# (connect, read) timeouts in seconds so a stalled server can't hang the script
+timeout = (5, 15)
 
-# Get task status if we get a task_id
-if "task_id" in response.json():
-    task_id = response.json()["task_id"]
-    status_response = requests.get(
-        f"{url}/task/{task_id}",
-        headers=headers
-    )
-    print("Task status:", status_response.json())
\ No newline at end of file
+# Reuse one keep-alive connection for both requests
+with requests.Session() as session:
+    session.headers.update(headers)
+
+    try:
+        # Test crawl - note the "urls" field instead of "url"
+        response = session.post(
+            f"{url}/crawl",
+            json={
+                "urls": "https://example.com",  # Changed from url to urls
+                "priority": 10
+            },
+            timeout=timeout
+        )
+        print(response.json())
+
+        # Get task status if we get a task_id
+        if "task_id" in response.json():
+            task_id = response.json()["task_id"]
+            status_response = session.get(f"{url}/task/{task_id}", timeout=timeout)
+            print("Task status:", status_response.json())
+    except requests.Timeout as e:
+        print(f"Request timed out: {e}")
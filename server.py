@@ -2,6 +2,8 @@ import os
 from dotenv import load_dotenv
 import logging
 import time
+import hmac
+import hashlib
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,7 +25,9 @@ os.environ['HOME'] = os.getenv('HOME', '/app')
 db_path = os.environ['CRAWL4AI_DB_PATH']
 os.makedirs(db_path, exist_ok=True)
 
-from fastapi import FastAPI, HTTPException, Depends, Security, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Security, status
+from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from crawl4ai import AsyncWebCrawler, CrawlerRunConfig, BrowserConfig, CacheMode
 from crawl4ai.extraction_strategy import JsonCssExtractionStrategy
@@ -33,7 +37,11 @@ from pydantic import BaseModel, Field
 import uvicorn
 import asyncio
 import uuid
-from typing import Dict, Any, Union, List, Optional
+import orjson
+import redis.asyncio as aioredis
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Any, Union, List, Optional, Set, Tuple
 from contextlib import asynccontextmanager
 
 # Configuration
@@ -42,6 +50,12 @@ MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", "5"))
 PORT = int(os.getenv("PORT", "11235"))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DB_PATH = os.getenv("CRAWL4AI_DB_PATH", "/app/data")
+REDIS_URL = os.getenv("REDIS_URL")
+TASK_TTL_SECONDS = int(os.getenv("TASK_TTL_SECONDS", "3600"))
+TASK_CACHE_SIZE = int(os.getenv("TASK_CACHE_SIZE", "256"))
+MULTI_URL_CONCURRENCY = 5  # pages crawled at once within a single multi-URL task
+LONG_POLL_MAX_WAIT = 30  # seconds a status request may be held open
+LONG_POLL_INTERVAL = 0.25  # seconds between task store checks while holding
 
 # Security
 security = HTTPBearer()
@@ -61,16 +75,92 @@ class CrawlRequest(BaseModel):
     wait_for: str = Field(default="domcontentloaded", description="Wait condition: domcontentloaded, load, networkidle0, networkidle2")
     page_timeout: int = Field(default=30000, ge=1000, le=60000, description="Page load timeout in milliseconds (1-60s)")
 
+class TaskStore:
+    """Crawl task state, shared through Redis when REDIS_URL is set.
+    
+    Without Redis, state lives in process: pending tasks in a plain dict that is
+    never evicted, finished tasks in a bounded LRU with the same TTL, so only
+    finished results can ever be dropped. With Redis, only finished tasks are cached locally since their state never
+    changes again; pending tasks are always read from Redis so that every
+    worker sees updates made by the others.
+    
+    State is encoded to JSON once when it is set. The cache keeps only what the
+    status endpoint needs: the status string, the encoded bytes and an ETag
+    derived from them. Finished results carry full page markdown, so the
+    decoded dict is not kept alongside its encoding.
+    """
+    
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = 3600, cache_size: int = 1000):
+        self.redis = aioredis.from_url(redis_url) if redis_url else None
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[float, str, bytes, str]]" = OrderedDict()
+        self._pending: Dict[str, Tuple[bytes, str]] = {}
+    
+    def _remember(self, task_id: str, task_status: str, payload: bytes) -> str:
+        # Weak, since GZipMiddleware may serve the same JSON gzip-encoded or as-is
+        etag = f'W/"{hashlib.blake2b(payload, digest_size=16).hexdigest()}"'
+        if task_status == "pending":
+            self._cache.pop(task_id, None)
+            if self.redis is None:
+                self._pending[task_id] = (payload, etag)
+            return etag
+        self._pending.pop(task_id, None)
+        self._cache[task_id] = (time.monotonic() + self.ttl, task_status, payload, etag)
+        self._cache.move_to_end(task_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return etag
+    
+    async def lookup(self, task_id: str) -> Optional[Tuple[str, bytes, str]]:
+        """Return a task's status along with its encoded JSON and ETag"""
+        pending = self._pending.get(task_id)
+        if pending is not None:
+            return "pending", pending[0], pending[1]
+        cached = self._cache.get(task_id)
+        if cached is not None:
+            expires_at, task_status, payload, etag = cached
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(task_id)
+                return task_status, payload, etag
+            del self._cache[task_id]
+        if self.redis is None:
+            return None
+        payload = await self.redis.get(f"task:{task_id}")
+        if payload is None:
+            return None
+        # Decoded only to read the status; the dict is dropped straight away
+        task_status = orjson.loads(payload).get("status")
+        etag = self._remember(task_id, task_status, payload)
+        return task_status, payload, etag
+    
+    async def set(self, task_id: str, state: Dict[str, Any]):
+        payload = orjson.dumps(state)
+        if self.redis is not None:
+            await self.redis.set(f"task:{task_id}", payload, ex=self.ttl)
+        self._remember(task_id, state.get("status"), payload)
+    
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
 # Global state
 crawler = None
-tasks: Dict[str, Any] = {}
+task_store = TaskStore(REDIS_URL, ttl=TASK_TTL_SECONDS, cache_size=TASK_CACHE_SIZE)
+running_tasks: Set[asyncio.Task] = set()
 task_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> bool:
-    """Verify API token if configured"""
-    if not API_TOKEN:
-        return True
-    return credentials.credentials == API_TOKEN
+def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)):
+    """Reject requests whose bearer token doesn't match API_TOKEN (constant-time)"""
+    if not hmac.compare_digest(credentials.credentials.encode(), API_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+# Only wire up token checks when a token is configured
+auth_dependencies = [Depends(verify_token)] if API_TOKEN else []
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -79,6 +169,7 @@ async def lifespan(app: FastAPI):
     logger.info("Starting server initialization...")
     logger.info(f"Using database path: {DB_PATH}")
     logger.info(f"Chrome flags: {CHROME_FLAGS}")
+    logger.info(f"Task store: {'redis' if REDIS_URL else 'in-memory'}")
     
     browser_config = BrowserConfig(
         headless=True,
@@ -103,6 +194,7 @@ async def lifespan(app: FastAPI):
         raise
     finally:
         logger.info("Shutting down server...")
+        await task_store.close()
         crawler = None
 
 app = FastAPI(
@@ -112,21 +204,22 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Compress larger responses (crawl results are markdown-heavy JSON) for
+# clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
         "max_concurrent_tasks": MAX_CONCURRENT_TASKS,
-        "active_tasks": len(tasks),
+        "active_tasks": len(running_tasks),
         "llm_enabled": False  # LLM support disabled for now
     }
 
-@app.post("/crawl")
-async def crawl(
-    request: CrawlRequest,
-    token: bool = Depends(verify_token)
-):
+@app.post("/crawl", dependencies=auth_dependencies)
+async def crawl(request: CrawlRequest):
     """Submit a new crawl job"""
     if request.use_llm:
         raise HTTPException(
@@ -135,31 +228,147 @@ async def crawl(
         )
     
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {"status": "pending", "result": None}
+    await task_store.set(task_id, {"status": "pending", "result": None})
     
-    # Start crawling in background
-    asyncio.create_task(process_crawl(task_id, request))
+    # Start crawling in background, keeping a reference until it finishes
+    task = asyncio.create_task(process_crawl(task_id, request))
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
     
     return {"task_id": task_id}
 
-@app.get("/task/{task_id}")
+def _opaque_tag(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against a response ETag
+    
+    Uses the weak comparison RFC 9110 prescribes for If-None-Match, so W/
+    prefixes on either side are ignored.
+    """
+    if not if_none_match:
+        return False
+    tags = [_opaque_tag(tag) for tag in if_none_match.split(",")]
+    return "*" in tags or _opaque_tag(etag) in tags
+
+@app.get("/task/{task_id}", dependencies=auth_dependencies)
 async def get_task_status(
     task_id: str,
-    token: bool = Depends(verify_token)
+    wait: float = Query(default=0, ge=0, le=LONG_POLL_MAX_WAIT, description="Seconds to hold the request while the task is pending"),
+    if_none_match: Optional[str] = Header(default=None)
 ):
-    """Get status of a crawl task"""
-    if task_id not in tasks:
+    """Get status of a crawl task, optionally long-polling until it finishes
+    
+    Responses carry an ETag; a request whose If-None-Match still matches gets
+    a bodiless 304 so clients can reuse a result they already downloaded.
+    """
+    found = await task_store.lookup(task_id)
+    if found is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Task not found"
         )
-    return tasks[task_id]
+    
+    deadline = time.monotonic() + wait
+    while found[0] == "pending" and time.monotonic() < deadline:
+        await asyncio.sleep(LONG_POLL_INTERVAL)
+        found = await task_store.lookup(task_id) or found
+    
+    # The X-Long-Poll-Max-Wait header tells clients long-polling is available
+    headers = {"ETag": found[2], "X-Long-Poll-Max-Wait": str(LONG_POLL_MAX_WAIT)}
+    if etag_matches(if_none_match, found[2]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    # Already-encoded JSON, sent as-is
+    return Response(content=found[1], media_type="application/json", headers=headers)
+
+# Browser settings applied to every crawl
+CRAWL_BROWSER_CONFIG = BrowserConfig(
+    headless=True,
+    verbose=True,
+    extra_args=[
+        "--disable-gpu",
+        "--no-sandbox",
+        "--disable-dev-shm-usage"
+    ],
+    viewport_width=1920,
+    viewport_height=1080
+)
+
+@lru_cache(maxsize=128)
+def build_crawl_config(
+    content_filter_type: str,
+    filter_threshold: float,
+    search_query: Optional[str],
+    schema_json: Optional[bytes],
+    wait_condition: str,
+    page_timeout: int
+) -> CrawlerRunConfig:
+    """Build (and memoize) the crawler config for a set of request options
+    
+    The config is shared by concurrent crawls. Its filter and strategies keep
+    no per-crawl state; crawl4ai only writes config.url, which is read for the
+    default cookiesEnabled cookie on new browser contexts.
+    """
+    # Setup content filter
+    content_filter = None
+    if content_filter_type == "pruning":
+        content_filter = PruningContentFilter(
+            threshold=filter_threshold,
+            threshold_type="dynamic",
+            min_word_threshold=50
+        )
+    elif content_filter_type == "bm25" and search_query:
+        content_filter = BM25ContentFilter(
+            user_query=search_query,
+            bm25_threshold=filter_threshold
+        )
+    
+    # Setup markdown generator with content filter
+    md_generator = DefaultMarkdownGenerator(
+        content_filter=content_filter
+    )
+    
+    # Setup JSON extraction if requested
+    extraction_strategy = None
+    if schema_json is not None:
+        extraction_strategy = JsonCssExtractionStrategy(
+            schema=orjson.loads(schema_json),
+            verbose=True
+        )
+    
+    # Configure crawler with optimized settings
+    return CrawlerRunConfig(
+        cache_mode=CacheMode.ENABLED,
+        markdown_generator=md_generator,
+        extraction_strategy=extraction_strategy,
+        word_count_threshold=50,
+        wait_until=wait_condition,
+        page_timeout=page_timeout,
+        wait_for_images=True
+    )
+
+def summarize_result(url: str, result: Any, extract_json: bool) -> Dict[str, Any]:
+    """Shape a successful crawl result for the task payload"""
+    return {
+        "url": url,
+        "raw_markdown": result.markdown_v2.raw_markdown if hasattr(result, 'markdown_v2') else None,
+        "fit_markdown": result.markdown_v2.fit_markdown if hasattr(result, 'markdown_v2') else None,
+        "extracted_json": result.extracted_content if extract_json else None,
+        "links": result.links if hasattr(result, 'links') else [],
+        "images": result.images if hasattr(result, 'images') else [],
+        "stats": {
+            "crawl_time_ms": int((time.time() - result.start_time) * 1000) if hasattr(result, 'start_time') else None,
+            "page_size_bytes": len(result.raw_html) if hasattr(result, 'raw_html') else None
+        }
+    }
 
 async def process_crawl(task_id: str, request: CrawlRequest):
     """Process a crawl request with advanced extraction"""
     async with task_semaphore:
         try:
-            url = request.urls if isinstance(request.urls, str) else request.urls[0]
+            urls = [request.urls] if isinstance(request.urls, str) else request.urls
             
             # Cap timeout and handle wait conditions
             page_timeout = min(request.page_timeout, 30000)  # Max 30 seconds
@@ -167,96 +376,89 @@ async def process_crawl(task_id: str, request: CrawlRequest):
             if wait_condition == "networkidle0":
                 wait_condition = "domcontentloaded"  # More reliable default
             
-            # Setup content filter
-            content_filter = None
-            if request.content_filter == "pruning":
-                content_filter = PruningContentFilter(
-                    threshold=request.filter_threshold,
-                    threshold_type="dynamic",
-                    min_word_threshold=50
-                )
-            elif request.content_filter == "bm25" and request.search_query:
-                content_filter = BM25ContentFilter(
-                    user_query=request.search_query,
-                    bm25_threshold=request.filter_threshold
-                )
-            
-            # Setup markdown generator with content filter
-            md_generator = DefaultMarkdownGenerator(
-                content_filter=content_filter
+            # Identical requests share one prebuilt config; the schema is keyed
+            # by its canonical JSON since dicts aren't hashable
+            schema_json = None
+            if request.extract_json and request.custom_schema:
+                schema_json = orjson.dumps(request.custom_schema, option=orjson.OPT_SORT_KEYS)
+            config = build_crawl_config(
+                request.content_filter,
+                request.filter_threshold,
+                request.search_query if request.content_filter == "bm25" else None,
+                schema_json,
+                wait_condition,
+                page_timeout
             )
             
-            # Setup JSON extraction if requested
-            extraction_strategy = None
-            if request.extract_json and request.custom_schema:
-                extraction_strategy = JsonCssExtractionStrategy(
-                    schema=request.custom_schema,
-                    verbose=True
-                )
+            logger.info(f"Starting crawl for {', '.join(urls)} with wait condition: {wait_condition}, timeout: {page_timeout}ms")
             
-            # Configure crawler with optimized settings
-            config = CrawlerRunConfig(
-                cache_mode=CacheMode.ENABLED,
-                markdown_generator=md_generator,
-                extraction_strategy=extraction_strategy,
-                word_count_threshold=50,
-                wait_until=wait_condition,
-                page_timeout=page_timeout,
-                wait_for_images=True
-            )
+            if len(urls) == 1:
+                url = urls[0]
+                result = await crawler.arun(
+                    url=url,
+                    config=config,
+                    browser_config=CRAWL_BROWSER_CONFIG
+                )
+                
+                if result.success:
+                    await task_store.set(task_id, {
+                        "status": "completed",
+                        "result": summarize_result(url, result, request.extract_json)
+                    })
+                    logger.info(f"Successfully crawled {url}")
+                else:
+                    error_msg = result.error_message if hasattr(result, 'error_message') else str(result)
+                    logger.error(f"Failed to crawl {url}: {error_msg}")
+                    await task_store.set(task_id, {
+                        "status": "failed",
+                        "error": error_msg
+                    })
+                return
             
-            # Configure browser with optimized settings
-            browser_config = BrowserConfig(
-                headless=True,
-                verbose=True,
-                extra_args=[
-                    "--disable-gpu",
-                    "--no-sandbox",
-                    "--disable-dev-shm-usage"
-                ],
-                viewport_width=1920,
-                viewport_height=1080
-            )
+            # Several URLs in one task: crawl them together and report each one
+            # under result["results"]. Each page goes through arun exactly like
+            # the single-URL case; arun_many in crawl4ai 0.4.247 hands its
+            # config to arun under a keyword arun ignores, dropping the options
+            page_slots = asyncio.Semaphore(MULTI_URL_CONCURRENCY)
             
-            logger.info(f"Starting crawl for {url} with wait condition: {wait_condition}, timeout: {page_timeout}ms")
+            async def crawl_page(url: str):
+                async with page_slots:
+                    return await crawler.arun(
+                        url=url,
+                        config=config,
+                        browser_config=CRAWL_BROWSER_CONFIG
+                    )
             
-            result = await crawler.arun(
-                url=url,
-                config=config,
-                browser_config=browser_config
-            )
+            results = await asyncio.gather(*(crawl_page(url) for url in urls), return_exceptions=True)
+            entries = []
+            for url, result in zip(urls, results):
+                if isinstance(result, Exception) or not result.success:
+                    error_msg = str(result) if isinstance(result, Exception) else result.error_message
+                    logger.error(f"Failed to crawl {url}: {error_msg}")
+                    entries.append({"url": url, "error": error_msg})
+                else:
+                    entries.append(summarize_result(url, result, request.extract_json))
             
-            if result.success:
-                tasks[task_id] = {
+            succeeded = sum(1 for entry in entries if "error" not in entry)
+            logger.info(f"Successfully crawled {succeeded}/{len(urls)} URLs")
+            if succeeded:
+                await task_store.set(task_id, {
                     "status": "completed",
-                    "result": {
-                        "url": url,
-                        "raw_markdown": result.markdown_v2.raw_markdown if hasattr(result, 'markdown_v2') else None,
-                        "fit_markdown": result.markdown_v2.fit_markdown if hasattr(result, 'markdown_v2') else None,
-                        "extracted_json": result.extracted_content if request.extract_json else None,
-                        "links": result.links if hasattr(result, 'links') else [],
-                        "images": result.images if hasattr(result, 'images') else [],
-                        "stats": {
-                            "crawl_time_ms": int((time.time() - result.start_time) * 1000) if hasattr(result, 'start_time') else None,
-                            "page_size_bytes": len(result.raw_html) if hasattr(result, 'raw_html') else None
-                        }
-                    }
-                }
-                logger.info(f"Successfully crawled {url}")
+                    "result": {"results": entries}
+                })
             else:
-                error_msg = result.error_message if hasattr(result, 'error_message') else str(result)
-                logger.error(f"Failed to crawl {url}: {error_msg}")
-                tasks[task_id] = {
+                await task_store.set(task_id, {
                     "status": "failed",
-                    "error": error_msg
-                }
+                    "error": f"All {len(urls)} URLs failed",
+                    "result": {"results": entries}
+                })
                 
         except Exception as e:
             logger.error(f"Error processing crawl request: {str(e)}")
-            tasks[task_id] = {
+            await task_store.set(task_id, {
                 "status": "failed",
                 "error": str(e)
-            }
+            })
 
 if __name__ == "__main__":
     logger.info(f"Starting server on port {PORT}")
@@ -1,117 +1,439 @@
+from __future__ import annotations
+
 import asyncio
-import json
-import requests
-import time
+import logging
+import httpx
+import msgspec
+import orjson
 import os
-from typing import Optional, Dict, Any
+import random
+import reprlib
+import time
+from functools import cache
+from typing import Any, Optional
 from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 # Configuration
 DEFAULT_URL = "https://jim-production.up.railway.app"
-API_URL = os.getenv("CRAWL4AI_API_URL", DEFAULT_URL)
-API_TOKEN = os.getenv("CRAWL4AI_API_TOKEN", "jeremy")
 
-def test_crawl(url: str = "https://baretread.com/products/", api_url: Optional[str] = None) -> Optional[Dict[str, Any]]:
+@cache
+def _config() -> tuple[str, str]:
+    """Resolve the API URL and token, reading .env only when the environment lacks them"""
+    if "CRAWL4AI_API_URL" not in os.environ or "CRAWL4AI_API_TOKEN" not in os.environ:
+        load_dotenv()
+    return (
+        os.environ.get("CRAWL4AI_API_URL", DEFAULT_URL),
+        os.environ.get("CRAWL4AI_API_TOKEN", "jeremy")
+    )
+
+API_URL, API_TOKEN = _config()
+
+# Only advertise brotli when the optional decoder is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Upper bound on concurrent crawl tests in test_crawl_many
+MAX_PARALLEL_TESTS = 32
+
+# Headers sent with every API request
+_API_HEADERS = {
+    "Authorization": f"Bearer {API_TOKEN}",
+    "Content-Type": "application/json",
+    # Crawl results are large markdown-heavy JSON; httpx decompresses the
+    # body transparently as it streams in
+    "Accept-Encoding": ACCEPT_ENCODING
+}
+
+# Task polling: start fast, back off exponentially with jitter, and give up
+# once the overall deadline passes
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 8.0
+POLL_BACKOFF_FACTOR = 1.7
+POLL_JITTER = 0.25
+POLL_DEADLINE = 120  # seconds
+# Servers that support long-polling hold each status request up to this long
+# while the task is pending, replacing the client-side backoff sleeps
+POLL_LONG_WAIT = 25  # seconds
+
+# Per-request timeouts: a dropped connection fails fast instead of hanging the
+# poll loop. Long-poll requests extend the read timeout by the wait they ask for
+CONNECT_TIMEOUT = 3.05  # seconds
+READ_TIMEOUT = 10  # seconds
+REQUEST_TIMEOUT = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+# Connection errors, timeouts and gateway errors are retried with exponential backoff
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = frozenset({502, 503, 504})
+
+# Completed task results are kept on disk next to their ETag, so fetching the
+# same task again sends If-None-Match and reads the body locally on a 304
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "jim", "results")
+RESULT_CACHE_MAX_ENTRIES = 64
+
+# Response shapes, decoded straight from bytes. Struct fields are resolved at
+# runtime, so they keep Optional rather than X | None for Python 3.9
+class TaskSubmitted(msgspec.Struct):
+    task_id: Optional[str] = None
+
+class TaskStatus(msgspec.Struct):
+    status: str
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+# Console preview of a crawl result: truncated per container and string, so
+# it costs the same on a 50 MB result as on a tiny one
+_PREVIEW_REPR = reprlib.Repr()
+_PREVIEW_REPR.maxlevel = 3
+_PREVIEW_REPR.maxdict = 10
+_PREVIEW_REPR.maxlist = 5
+_PREVIEW_REPR.maxstring = 80
+_PREVIEW_REPR.maxother = 80
+
+# Health probe results per API URL, reused for a short while so repeated test
+# runs against the same endpoint don't each pay a round trip
+HEALTH_CACHE_TTL = 30  # seconds
+_HEALTH_CACHE: dict[str, tuple[float, bool]] = {}
+
+async def health_ok(api_url: str, client: httpx.AsyncClient) -> bool:
+    """Check the service health endpoint, reusing a recent result for the same API URL"""
+    now = time.monotonic()
+    hit = _HEALTH_CACHE.get(api_url)
+    if hit and now - hit[0] < HEALTH_CACHE_TTL:
+        return hit[1]
+    health_response = await client.get(f"{api_url}/health", timeout=3)
+    ok = health_response.is_success
+    _HEALTH_CACHE[api_url] = (now, ok)
+    return ok
+
+def dumps_pretty(obj: Any) -> str:
+    """Indented JSON for human-readable output"""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+def retry_after_seconds(value: str | None) -> float | None:
+    """Parse a delay-seconds Retry-After header; HTTP-date values are ignored"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+def _result_cache_path(task_id: str, suffix: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, os.path.basename(task_id) + suffix)
+
+def load_cached_result(task_id: str) -> tuple[str, bytes] | None:
+    """Return the saved ETag and body for a completed task, if any"""
+    try:
+        with open(_result_cache_path(task_id, ".etag")) as f:
+            etag = f.read().strip()
+        with open(_result_cache_path(task_id, ".json"), "rb") as f:
+            body = f.read()
+    except OSError:
+        return None
+    return (etag, body) if etag else None
+
+def store_cached_result(task_id: str, body: bytes, etag: str) -> None:
+    """Save a completed task's body and ETag, evicting the least recently stored entries"""
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        # The body goes first so an ETag on disk always has a complete body beside it
+        with open(_result_cache_path(task_id, ".json"), "wb") as f:
+            f.write(body)
+        with open(_result_cache_path(task_id, ".etag"), "w") as f:
+            f.write(etag)
+        with os.scandir(RESULT_CACHE_DIR) as it:
+            entries = sorted(
+                (entry for entry in it if entry.name.endswith(".json")),
+                key=lambda entry: entry.stat().st_mtime
+            )
+        for entry in entries[:max(0, len(entries) - RESULT_CACHE_MAX_ENTRIES)]:
+            stale_id = entry.name[:-len(".json")]
+            for suffix in (".etag", ".json"):
+                try:
+                    os.remove(_result_cache_path(stale_id, suffix))
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        logger.warning(f"Could not cache result for task {task_id}: {e}")
+
+def create_client(max_connections: int = 4) -> httpx.AsyncClient:
+    """Create a keep-alive HTTP/2 client carrying the API auth headers
+    
+    Over HTTPS concurrent requests are multiplexed as streams on a single
+    connection; max_connections only comes into play when the server falls
+    back to HTTP/1.1.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        headers=_API_HEADERS,
+        timeout=REQUEST_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=30
+        )
+    )
+
+async def send_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    **kwargs: Any
+) -> httpx.Response:
+    """Send a request, retrying transient failures
+    
+    Error statuses raise httpx.HTTPStatusError; a 304 Not Modified is returned
+    as-is for conditional requests to handle.
+    """
+    attempt = 0
+    while True:
+        retries_left = attempt < RETRY_TOTAL
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code in RETRY_STATUSES and retries_left:
+                logger.info(f"{method} {url} returned {response.status_code}, retrying")
+            else:
+                if response.status_code != 304:
+                    response.raise_for_status()
+                return response
+        except httpx.TransportError as e:
+            if not retries_left:
+                raise
+            logger.info(f"{method} {url} failed ({type(e).__name__}: {e}), retrying")
+        await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2 ** attempt))
+        attempt += 1
+
+async def request_json(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    response_type: Any = None,
+    **kwargs: Any
+) -> tuple[Any, Any]:
+    """Send a request and decode its JSON body, retrying transient failures
+    
+    Args:
+        response_type: Optional msgspec type to decode and validate the body as
+    
+    Returns:
+        Tuple of the decoded body and the response headers
+    """
+    response = await send_with_retry(client, method, url, **kwargs)
+    if response_type is None:
+        return orjson.loads(response.content), response.headers
+    return msgspec.json.decode(response.content, type=response_type), response.headers
+
+async def test_crawl_async(
+    url: str | list[str] = "https://baretread.com/products/",
+    api_url: str | None = None,
+    client: httpx.AsyncClient | None = None,
+    task_id: str | None = None
+) -> dict[str, Any] | None:
     """Test the crawling functionality of the service
     
     Args:
-        url: The URL to crawl
+        url: The URL to crawl, or a list of URLs to crawl as a single task
         api_url: Optional API URL override
+        client: Optional shared client; a new one is created if omitted
+        task_id: Fetch the result of an existing task instead of submitting url
     
     Returns:
-        Dict containing the crawl results or None if failed
+        Dict containing the crawl results or None if failed. A multi-URL task
+        returns one entry per URL under "results".
     """
-    api_url = api_url or API_URL
-    print(f"\nTesting crawl for: {url}")
-    print(f"Using API endpoint: {api_url}")
+    if client is None:
+        async with create_client() as client:
+            return await test_crawl_async(url=url, api_url=api_url, client=client, task_id=task_id)
     
-    # Always include Authorization header with the token
-    headers = {
-        "Authorization": f"Bearer {API_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    api_url = api_url or API_URL
+    urls = [url] if isinstance(url, str) else list(url)
+    if task_id:
+        logger.info(f"Fetching task: {task_id}")
+    else:
+        logger.info(f"Testing crawl for: {', '.join(urls)}")
+    logger.info(f"Using API endpoint: {api_url}")
     
     try:
         # Test health check
-        health_response = requests.get(f"{api_url}/health", headers=headers)
-        health_response.raise_for_status()
-        print("Health check passed!")
-        
-        # Submit crawl job
-        crawl_url = f"{api_url}/crawl"
-        payload = {
-            "urls": url,
-            "priority": 1
-        }
-        
-        print("\nSubmitting payload:", json.dumps(payload, indent=2))
-        response = requests.post(crawl_url, json=payload, headers=headers)
-        response.raise_for_status()
-        result = response.json()
+        if not await health_ok(api_url, client):
+            logger.error("Health check failed")
+            return None
+        logger.info("Health check passed!")
         
-        print("\nCrawl job submitted:", json.dumps(result, indent=2))
+        if not task_id:
+            # Submit crawl job
+            crawl_url = f"{api_url}/crawl"
+            payload = {
+                "urls": urls,
+                "priority": 1
+            }
+            
+            # Full payload dumps cost a serialization, so only build them when debugging
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Submitting payload: {dumps_pretty(payload)}")
+            submitted, _ = await request_json(
+                client, "POST", crawl_url, response_type=TaskSubmitted, json=payload
+            )
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Crawl job submitted: {dumps_pretty(msgspec.to_builtins(submitted))}")
+            
+            task_id = submitted.task_id
+            if not task_id:
+                logger.error("No task ID received")
+                return None
         
         # Poll for results
-        task_id = result.get("task_id")
-        if not task_id:
-            print("No task ID received")
-            return None
+        task_url = f"{api_url}/task/{task_id}"
+        cached = load_cached_result(task_id)
+        conditional_headers = {"If-None-Match": cached[0]} if cached else None
             
-        max_retries = 30
-        retry_delay = 2
+        deadline = time.monotonic() + POLL_DEADLINE
+        delay = POLL_INITIAL_DELAY
+        attempt = 0
         
-        for i in range(max_retries):
-            task_response = requests.get(f"{api_url}/task/{task_id}", headers=headers)
-            task_response.raise_for_status()
-            task_result = task_response.json()
+        while time.monotonic() < deadline:
+            attempt += 1
+            # Servers without long-poll support ignore the wait parameter and
+            # answer straight away, leaving the backoff below in charge
+            long_wait = min(POLL_LONG_WAIT, max(0.0, deadline - time.monotonic()))
+            task_response = await send_with_retry(
+                client, "GET", task_url,
+                params={"wait": f"{long_wait:.1f}"},
+                headers=conditional_headers,
+                timeout=httpx.Timeout(long_wait + READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+            )
+            not_modified = task_response.status_code == 304 and cached is not None
+            body = cached[1] if not_modified else task_response.content
+            task_status = msgspec.json.decode(body, type=TaskStatus)
+            retry_after = retry_after_seconds(task_response.headers.get("Retry-After"))
+            long_polled = "X-Long-Poll-Max-Wait" in task_response.headers
             
-            if task_result["status"] == "completed":
-                print("\nCrawl completed successfully!")
-                return task_result["result"]
-            elif task_result["status"] == "failed":
-                print(f"\nCrawl failed: {task_result.get('error')}")
+            if task_status.status == "completed":
+                if not_modified:
+                    logger.info("Result unchanged, loaded from the local cache")
+                elif "ETag" in task_response.headers:
+                    store_cached_result(task_id, body, task_response.headers["ETag"])
+                logger.info("Crawl completed successfully!")
+                return task_status.result
+            elif task_status.status == "failed":
+                logger.error(f"Crawl failed: {task_status.error}")
                 return None
-            elif task_result["status"] == "pending":
-                print(f"Task pending... (attempt {i+1}/{max_retries})")
-                time.sleep(retry_delay)
+            elif task_status.status == "pending":
+                logger.info(f"Task pending... (attempt {attempt})")
+                if long_polled:
+                    # The server already held the request while the task ran
+                    continue
+                # Honor the server's hint when it gives one
+                wait = retry_after if retry_after is not None else delay
+                await asyncio.sleep(min(wait, max(0.0, deadline - time.monotonic())))
+                delay = min(POLL_MAX_DELAY, delay * POLL_BACKOFF_FACTOR) + random.uniform(0, POLL_JITTER)
                 continue
                 
-        print("\nTimeout waiting for results")
+        logger.error("Timeout waiting for results")
         return None
-            
+        
     except Exception as e:
-        print(f"Error: {str(e)}")
-        if hasattr(e, 'response') and hasattr(e.response, 'text'):
-            print(f"Response details: {e.response.text}")
+        logger.error(f"Error: {str(e)}")
+        if isinstance(e, httpx.HTTPStatusError):
+            logger.error(f"Response details: {e.response.status_code} {e.response.reason_phrase}")
         return None
 
-def save_results(results: Dict[str, Any], output_file: str):
-    """Save crawl results to a file"""
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-    print(f"\nResults saved to: {output_file}")
+def test_crawl(
+    url: str | list[str] = "https://baretread.com/products/",
+    api_url: str | None = None,
+    task_id: str | None = None
+) -> dict[str, Any] | None:
+    """Synchronous wrapper around test_crawl_async"""
+    return asyncio.run(test_crawl_async(url=url, api_url=api_url, task_id=task_id))
 
-if __name__ == "__main__":
+async def test_crawl_many(
+    urls: list[str],
+    api_url: str | None = None
+) -> list[dict[str, Any] | None]:
+    """Run test_crawl_async for several URLs concurrently, returning results in input order"""
+    # Over HTTP/2 every run shares one connection; the pool is still sized to
+    # the runs in flight so an HTTP/1.1 fallback doesn't queue long-polls
+    parallel = max(1, min(MAX_PARALLEL_TESTS, len(urls)))
+    slots = asyncio.Semaphore(parallel)
+    
+    async with create_client(max_connections=parallel) as client:
+        # Probe health once up front so every concurrent run hits the cache
+        try:
+            await health_ok(api_url or API_URL, client)
+        except Exception as e:
+            logger.error(f"Health check error: {e}")
+        
+        async def run_one(url: str) -> dict[str, Any] | None:
+            async with slots:
+                return await test_crawl_async(url=url, api_url=api_url, client=client)
+        
+        return await asyncio.gather(*(run_one(url) for url in urls))
+
+def save_results(results: dict[str, Any], output_file: str, pretty: bool = True):
+    """Save crawl results to a file
+    
+    The whole document is encoded to a single bytes object and written in one
+    call; pass pretty=False to skip indentation for large results.
+    """
+    option = orjson.OPT_NON_STR_KEYS
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(results, option=option))
+    logger.info(f"Results saved to: {output_file}")
+
+def preview(result: Any) -> str:
+    """Short repr of a result for logging, bounded regardless of result size"""
+    return _PREVIEW_REPR.repr(result)
+
+def main() -> None:
+    """Command-line entry point"""
     import argparse
     
     parser = argparse.ArgumentParser(description='Test the Crawl4AI service')
-    parser.add_argument('--url', default="https://baretread.com/products/",
-                      help='URL to crawl')
+    parser.add_argument('--urls', '--url', nargs='+', dest='urls',
+                      default=["https://baretread.com/products/"],
+                      help='URL(s) to crawl, submitted together as one task')
     parser.add_argument('--api-url', default=None,
                       help='API endpoint URL')
+    parser.add_argument('--task-id', default=None,
+                      help='Fetch the result of an existing task instead of submitting a new crawl')
     parser.add_argument('--output', default=None,
                       help='Output file for results')
+    parser.add_argument('--compact', action='store_true',
+                      help='Write the output file without indentation')
+    parser.add_argument('--verbose', action='store_true',
+                      help='Log full request and response payloads')
     
     args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(message)s"
+    )
+    if not args.verbose:
+        # httpx logs every request at INFO, which would bury the poll progress
+        logging.getLogger("httpx").setLevel(logging.WARNING)
     
-    result = test_crawl(url=args.url, api_url=args.api_url)
+    result = test_crawl(url=args.urls, api_url=args.api_url, task_id=args.task_id)
     
     if result:
-        print("\nExample of extracted content:")
-        print(json.dumps(result, indent=2)[:500] + "...")
+        # Multi-URL tasks report each URL under "results"
+        if "results" in result:
+            logger.info("Per-URL results:")
+            for entry in result["results"]:
+                logger.info(f"- {entry.get('url')}: {entry.get('error') or 'ok'}")
+        
+        logger.info(f"Example of extracted content: {preview(result)}")
         
         if args.output:
-            save_results(result, args.output) 
\ No newline at end of file
+            save_results(result, args.output, pretty=not args.compact)
+
+if __name__ == "__main__":
+    main()